@@ -8,7 +8,21 @@ components:
 """
 import numpy as np
 import math
-from frame_utils import euler2RM
+import functools
+from collections import namedtuple
+from frame_utils import euler2RM, euler2RM_batched
+
+numba_available = True
+try:
+    from numba import njit
+except ImportError:
+    numba_available = False
+
+    def njit(*args, **kwargs):
+        """Stand-in for numba.njit when numba is not installed: leaves the function as plain Python"""
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
 
 DRONE_MASS_KG = 0.5
 GRAVITY = -9.81
@@ -16,7 +30,390 @@ MOI = np.array([0.005, 0.005, 0.01])
 MAX_THRUST = 10.0
 MAX_TORQUE = 1.0
 
-class NonlinearController(object):
+# all the controller gains, in NonlinearController.__init__ argument order. A plain tuple: picklable and
+# accepted by the numba kernels
+Gains = namedtuple('Gains', ['z_k_p', 'z_k_d', 'x_k_p', 'x_k_d', 'y_k_p', 'y_k_d', 'k_p_roll', 'k_p_pitch', 'k_p_yaw',
+                             'k_p_p', 'k_p_q', 'k_p_r', 'max_roll_rad', 'max_pitch_rad'])
+
+
+@njit("float64(float64, float64, float64, float64, float64, float64, float64, float64)", cache=True, fastmath=True)
+def _altitude_kernel(altitude_cmd, vertical_velocity_cmd, altitude, vertical_velocity, b_z,
+                     acceleration_ff, z_k_p, z_k_d):
+    """Scalar core of NonlinearController.altitude_control"""
+    u_1_bar = z_k_p * (altitude_cmd - altitude) + z_k_d * (vertical_velocity_cmd - vertical_velocity) + acceleration_ff
+
+    c = (u_1_bar - GRAVITY) / b_z
+
+    return min(max(c, 0.0), MAX_THRUST)
+
+
+@njit("UniTuple(float64, 2)(float64, float64, float64, float64, float64, float64, float64, float64, float64, "
+      "float64, float64, float64, float64, float64, float64)", cache=True, fastmath=True)
+def _roll_pitch_kernel(b_x_c, b_y_c, r00, r01, r02, r10, r11, r12, r22, roll, pitch, k_p_roll, k_p_pitch,
+                       max_roll_rad, max_pitch_rad):
+    """Scalar core of NonlinearController.roll_pitch_controller, r00 .. r22 are the rot_mat entries it reads"""
+    b_x_p_term = k_p_roll * (b_x_c - r02)
+    b_y_p_term = k_p_pitch * (b_y_c - r12)
+
+    # [[r10, -r00], [r11, -r01]] / r22 times the p terms, written out
+    inv_b_z = 1.0 / r22
+    p_c = (r10 * b_x_p_term - r00 * b_y_p_term) * inv_b_z
+    q_c = (r11 * b_x_p_term - r01 * b_y_p_term) * inv_b_z
+
+    #if max angle is reached, no more rotation requested
+    in_roll = abs(roll) <= max_roll_rad
+    in_pitch = abs(pitch) <= max_pitch_rad
+    p_c = p_c if in_roll else 0.0
+    q_c = q_c if in_pitch else 0.0
+
+    return p_c, q_c
+
+
+@njit("UniTuple(float64, 2)(float64, float64, float64, float64, float64, float64, float64, float64)",
+      cache=True, fastmath=True)
+def _roll_pitch_q_kernel(b_x_c, b_y_c, q0, q1, q2, q3, k_p_roll, k_p_pitch):
+    """Scalar core of roll_pitch_controller_q"""
+    # rot_mat of the quaternion, as frame_utils.quaternion2RM
+    r00 = 1.0 - 2.0*(q2*q2 + q3*q3)
+    r01 = 2.0*(q1*q2 - q0*q3)
+    r02 = 2.0*(q1*q3 + q0*q2)
+    r10 = 2.0*(q1*q2 + q0*q3)
+    r11 = 1.0 - 2.0*(q1*q1 + q3*q3)
+    r12 = 2.0*(q2*q3 - q0*q1)
+    r20 = 2.0*(q1*q3 - q0*q2)
+    r21 = 2.0*(q2*q3 + q0*q1)
+    r22 = 1.0 - 2.0*(q1*q1 + q2*q2)
+
+    # commanded thrust direction in the world frame, b_x_c and b_y_c play the role of rot_mat[0, 2] and rot_mat[1, 2]
+    b_z_c = math.sqrt(max(1.0 - b_x_c*b_x_c - b_y_c*b_y_c, 0.0))
+    inv_b = 1.0 / math.sqrt(b_x_c*b_x_c + b_y_c*b_y_c + b_z_c*b_z_c)
+
+    # the same direction in the body frame, rot_mat.T @ b_c
+    v_x = (r00*b_x_c + r10*b_y_c + r20*b_z_c) * inv_b
+    v_y = (r01*b_x_c + r11*b_y_c + r21*b_z_c) * inv_b
+    v_z = (r02*b_x_c + r12*b_y_c + r22*b_z_c) * inv_b
+
+    # with q_d = q followed by the smallest rotation taking the body z axis onto v, the error
+    # q_e = q_d.conj() * q = (1 + v_z, v_y, -v_x, 0) / n, n = sqrt(2 * (1 + v_z)), and q_e0 >= 0.
+    # Its axis-angle vector xi = theta / sin(theta / 2) * q_e[1:] with sin(theta / 2) = s / n
+    # reduces to theta / s * (v_y, -v_x): n cancels, and theta / s -> 1 as s -> 0
+    # (v_z = -1, thrust exactly reversed, has no defined axis: s = 0 and no rate is commanded)
+    s = math.sqrt(v_x*v_x + v_y*v_y)
+    theta = 2.0 * math.atan2(s, 1.0 + v_z)
+    theta_over_s = theta / s if s > 1e-9 else 1.0
+
+    # thrust direction error theta * (v_x, v_y, 0) / s, rotated to the world frame where the gains apply
+    # as in roll_pitch_controller: k_p_roll to the north (b_x) error, k_p_pitch to the east (b_y) error.
+    # The vertical part only appears when tilted and takes the mean gain, so equal gains scale the error
+    # as a whole
+    e_x = theta_over_s * v_x
+    e_y = theta_over_s * v_y
+    d_x = k_p_roll * (r00*e_x + r01*e_y)
+    d_y = k_p_pitch * (r10*e_x + r11*e_y)
+    d_z = 0.5 * (k_p_roll + k_p_pitch) * (r20*e_x + r21*e_y)
+
+    # back to the body frame, body rates -K * xi
+    p_c = -(r01*d_x + r11*d_y + r21*d_z)
+    q_c = r00*d_x + r10*d_y + r20*d_z
+
+    return p_c, q_c
+
+
+@njit("UniTuple(float64, 3)(float64, float64, float64, float64, float64, float64, float64, float64, float64)",
+      cache=True, fastmath=True)
+def _body_rate_kernel(p_c, q_c, r_c, p_actual, q_actual, r_actual, moi_k_p, moi_k_q, moi_k_r):
+    """Scalar core of NonlinearController.body_rate_control, moi_k_* are the MOI * rate gain products"""
+    m_p = moi_k_p * (p_c - p_actual)
+    m_q = moi_k_q * (q_c - q_actual)
+    m_r = moi_k_r * (r_c - r_actual)
+
+    # scale = min(1, MAX_TORQUE/norm), no branch and no division by a zero norm
+    scale = MAX_TORQUE / max(MAX_TORQUE, math.sqrt(m_p*m_p + m_q*m_q + m_r*m_r))
+
+    return m_p * scale, m_q * scale, m_r * scale
+
+
+@njit(cache=True, fastmath=True)
+def step_kernel(local_position, local_velocity, attitude, body_rate, local_position_cmd, local_velocity_cmd,
+                yaw_cmd, acceleration_ff, gains):
+    """One full control step of a single drone, with no intermediate array
+    
+    Runs lateral_position_control, altitude_control, roll_pitch_controller, yaw_control
+    and body_rate_control in a single call, as ControlsFlyer chains them.
+    
+    Args:
+        local_position: 3-element numpy array, vehicle NED position
+        local_velocity: 3-element numpy array, vehicle NED velocity
+        attitude: 3-element numpy array (roll, pitch, yaw) in radians
+        body_rate: 3-element numpy array (p,q,r) in radians/second
+        local_position_cmd: 3-element numpy array, commanded NED position
+        local_velocity_cmd: 3-element numpy array, commanded NED velocity
+        yaw_cmd: commanded yaw in radians
+        acceleration_ff: 3-element numpy array, feedforward acceleration (north, east, up)
+        gains: Gains tuple
+        
+    Returns: tuple (thrust command, roll moment, pitch moment, yaw moment)
+    """
+    (z_k_p, z_k_d, x_k_p, x_k_d, y_k_p, y_k_d, k_p_roll, k_p_pitch, k_p_yaw,
+     k_p_p, k_p_q, k_p_r, max_roll_rad, max_pitch_rad) = gains
+    roll = attitude[0]
+    pitch = attitude[1]
+    yaw = attitude[2]
+
+    # one set of trig calls, only the rotation entries read below
+    cr = math.cos(roll)
+    sr = math.sin(roll)
+    cp = math.cos(pitch)
+    sp = math.sin(pitch)
+    cy = math.cos(yaw)
+    sy = math.sin(yaw)
+
+    r00 = cp*cy
+    r01 = -cr*sy+sr*sp*cy
+    r02 = sr*sy+cr*sp*cy
+    r10 = cp*sy
+    r11 = cr*cy+sr*sp*sy
+    r12 = -sr*cy+cr*sp*sy
+    r22 = cr*cp
+
+    # lateral_position_control
+    b_x_c = -(x_k_p * (local_position_cmd[0] - local_position[0]) +
+              x_k_d * (local_velocity_cmd[0] - local_velocity[0]) + acceleration_ff[0])
+    b_y_c = -(y_k_p * (local_position_cmd[1] - local_position[1]) +
+              y_k_d * (local_velocity_cmd[1] - local_velocity[1]) + acceleration_ff[1])
+
+    # altitude_control, NED down to +up
+    thrust = _altitude_kernel(-local_position_cmd[2], -local_velocity_cmd[2], -local_position[2], -local_velocity[2],
+                              r22, acceleration_ff[2], z_k_p, z_k_d)
+
+    # roll_pitch_controller
+    p_c, q_c = _roll_pitch_kernel(b_x_c, b_y_c, r00, r01, r02, r10, r11, r12, r22, roll, pitch, k_p_roll, k_p_pitch,
+                                  max_roll_rad, max_pitch_rad)
+
+    # yaw_control, wrapped to [-pi, pi) (math.remainder is not available in numba)
+    yaw_err = yaw_cmd - yaw
+    yaw_err = yaw_err - 2.0*math.pi * math.floor(yaw_err / (2.0*math.pi) + 0.5)
+    r_c = k_p_yaw * yaw_err
+
+    # body_rate_control. MOI is a global array, numba freezes it as a compile time constant (and the
+    # gains too in a _make_step function), so these products fold away
+    m_p, m_q, m_r = _body_rate_kernel(p_c, q_c, r_c, body_rate[0], body_rate[1], body_rate[2],
+                                      MOI[0] * k_p_p, MOI[1] * k_p_q, MOI[2] * k_p_r)
+
+    return thrust, m_p, m_q, m_r
+
+
+@functools.lru_cache(maxsize=64)
+def _make_step(gains):
+    """Compile a step_kernel specialized for one set of gains
+    
+    gains is captured by the closure, so numba freezes it as a compile time constant (like
+    the MOI, MAX_THRUST and MAX_TORQUE globals) and LLVM can fold the gain products.
+    Not cached on disk, but memoized per Gains tuple: controllers with the same gains share one
+    compiled function, and going back to earlier gains does not compile again.
+    """
+    @njit(fastmath=True)
+    def step(local_position, local_velocity, attitude, body_rate, local_position_cmd, local_velocity_cmd,
+             yaw_cmd, acceleration_ff):
+        return step_kernel(local_position, local_velocity, attitude, body_rate, local_position_cmd,
+                           local_velocity_cmd, yaw_cmd, acceleration_ff, gains)
+
+    return step
+
+
+def control_step(gains, state):
+    """step_kernel with the gains first, e.g. pool.map(functools.partial(control_step, gains), states)
+    
+    Args:
+        gains: Gains tuple
+        state: tuple of the other step_kernel arguments (local_position, local_velocity, attitude, body_rate,
+            local_position_cmd, local_velocity_cmd, yaw_cmd, acceleration_ff)
+            
+    Returns: tuple (thrust command, roll moment, pitch moment, yaw moment)
+    """
+    return step_kernel(*state, gains)
+
+
+# Pure function versions of the NonlinearController methods: everything they use comes in as arguments,
+# so they can run in worker processes. NonlinearController calls them with its own gains and buffers.
+
+def lateral_position_control(gains, local_position_cmd, local_velocity_cmd, local_position, local_velocity,
+                             acceleration_ff=(0.0, 0.0), out=None):
+    """Generate horizontal acceleration commands for the vehicle in the local frame
+
+    Args:
+        gains: Gains tuple
+        local_position_cmd: desired 2D position in local frame [north, east]
+        local_velocity_cmd: desired 2D velocity in local frame [north_velocity, east_velocity]
+        local_position: vehicle position in the local frame [north, east]
+        local_velocity: vehicle velocity in the local frame [north_velocity, east_velocity]
+        acceleration_ff: feedforward acceleration command
+        out: optional 2-element array to write the result to
+
+    Returns: desired vehicle 2D acceleration in the local frame [north, east]
+    """
+    if out is None:
+        out = np.empty(2)
+
+    out[0] = -(gains.x_k_p * (local_position_cmd[0] - local_position[0]) +
+               gains.x_k_d * (local_velocity_cmd[0] - local_velocity[0]) + acceleration_ff[0])
+    out[1] = -(gains.y_k_p * (local_position_cmd[1] - local_position[1]) +
+               gains.y_k_d * (local_velocity_cmd[1] - local_velocity[1]) + acceleration_ff[1])
+
+    return out
+
+
+def altitude_control(gains, altitude_cmd, vertical_velocity_cmd, altitude, vertical_velocity, attitude,
+                     acceleration_ff=0.0, rot_mat=None):
+    """Generate vertical acceleration (thrust) command
+
+    Args:
+        gains: Gains tuple
+        altitude_cmd: desired vertical position (+up)
+        vertical_velocity_cmd: desired vertical velocity (+up)
+        altitude: vehicle vertical position (+up)
+        vertical_velocity: vehicle vertical velocity (+up)
+        attitude: the vehicle's current attitude, 3 element numpy array (roll, pitch, yaw) in radians
+        acceleration_ff: feedforward acceleration command (+up)
+        rot_mat: optional rotation matrix of attitude, as returned by euler2RM
+
+    Returns: thrust command for the vehicle (+up)
+    """
+    if rot_mat is None:
+        # only rot_mat[2, 2] of euler2RM is needed
+        b_z = math.cos(attitude[0]) * math.cos(attitude[1])
+    else:
+        b_z = rot_mat[2, 2]
+
+    return _altitude_kernel(altitude_cmd, vertical_velocity_cmd, altitude, vertical_velocity,
+                            b_z, acceleration_ff, gains.z_k_p, gains.z_k_d)
+
+
+def altitude_control_q(gains, altitude_cmd, vertical_velocity_cmd, altitude, vertical_velocity, q,
+                       acceleration_ff=0.0):
+    """Generate vertical acceleration (thrust) command from a quaternion attitude
+
+    Args:
+        gains: Gains tuple
+        altitude_cmd: desired vertical position (+up)
+        vertical_velocity_cmd: desired vertical velocity (+up)
+        altitude: vehicle vertical position (+up)
+        vertical_velocity: vehicle vertical velocity (+up)
+        q: the vehicle's current attitude, 4 element numpy array unit quaternion (q0, q1, q2, q3)
+        acceleration_ff: feedforward acceleration command (+up)
+
+    Returns: thrust command for the vehicle (+up)
+    """
+    # rot_mat[2, 2] without any trig call
+    b_z = 1.0 - 2.0 * (q[1] * q[1] + q[2] * q[2])
+
+    return _altitude_kernel(altitude_cmd, vertical_velocity_cmd, altitude, vertical_velocity,
+                            b_z, acceleration_ff, gains.z_k_p, gains.z_k_d)
+
+
+def roll_pitch_controller(gains, acceleration_cmd, attitude, thrust_cmd, rot_mat=None, out=None):
+    """ Generate the rollrate and pitchrate commands in the body frame
+
+    Args:
+        gains: Gains tuple
+        acceleration_cmd: 2-element numpy array (north_acceleration_cmd,east_acceleration_cmd) in m/s^2
+        attitude: 3-element numpy array (roll, pitch, yaw) in radians
+        thrust_cmd: vehicle thrust command in Newton
+        rot_mat: optional rotation matrix of attitude, as returned by euler2RM
+            or by frame_utils.quaternion2RM for a quaternion attitude (no trig call). attitude is
+            still required: the max angle check reads roll and pitch from it
+        out: optional 2-element array to write the result to
+
+    Returns: 2-element numpy array, desired rollrate (p) and pitchrate (q) commands in radians/s
+    """
+    if out is None:
+        out = np.empty(2)
+
+    if rot_mat is None:
+        rot_mat = euler2RM(attitude[0], attitude[1], attitude[2])
+
+    out[0], out[1] = _roll_pitch_kernel(acceleration_cmd[0], acceleration_cmd[1], rot_mat[0, 0], rot_mat[0, 1],
+                                        rot_mat[0, 2], rot_mat[1, 0], rot_mat[1, 1], rot_mat[1, 2], rot_mat[2, 2],
+                                        attitude[0], attitude[1], gains.k_p_roll, gains.k_p_pitch,
+                                        gains.max_roll_rad, gains.max_pitch_rad)
+
+    return out
+
+
+def roll_pitch_controller_q(gains, acceleration_cmd, q, thrust_cmd, out=None):
+    """ Generate the rollrate and pitchrate commands in the body frame from a quaternion attitude error
+
+    Commands the rotation, as an axis-angle vector, that takes the body z axis onto the commanded
+    direction. Unlike roll_pitch_controller nothing is divided by rot_mat[2, 2], so it stays defined
+    past 90 degrees of roll or pitch; there is no max angle check as there are no euler angles.
+    k_p_roll and k_p_pitch act on the north and east errors as in roll_pitch_controller, and the
+    two agree near level flight.
+
+    Args:
+        gains: Gains tuple
+        acceleration_cmd: 2-element numpy array (north_acceleration_cmd,east_acceleration_cmd) in m/s^2
+        q: the vehicle's current attitude, 4 element numpy array unit quaternion (q0, q1, q2, q3)
+        thrust_cmd: vehicle thrust command in Newton
+        out: optional 2-element array to write the result to
+
+    Returns: 2-element numpy array, desired rollrate (p) and pitchrate (q) commands in radians/s
+    """
+    if out is None:
+        out = np.empty(2)
+
+    out[0], out[1] = _roll_pitch_q_kernel(acceleration_cmd[0], acceleration_cmd[1], q[0], q[1], q[2], q[3],
+                                          gains.k_p_roll, gains.k_p_pitch)
+
+    return out
+
+
+def body_rate_control(gains, body_rate_cmd, body_rate, out=None, moi_k_rate=None):
+    """ Generate the roll, pitch, yaw moment commands in the body frame
+
+    Args:
+        gains: Gains tuple
+        body_rate_cmd: 3-element numpy array (p_cmd,q_cmd,r_cmd) in radians/second^2
+        body_rate: 3-element numpy array (p,q,r) in radians/second^2
+        out: optional 3-element array to write the result to
+        moi_k_rate: optional precomputed MOI * (k_p_p, k_p_q, k_p_r), computed from gains if None
+
+    Returns: 3-element numpy array, desired roll moment, pitch moment, and yaw moment commands in Newtons*meters
+    """
+    if out is None:
+        out = np.empty(3)
+
+    if moi_k_rate is None:
+        moi_k_rate = (MOI[0] * gains.k_p_p, MOI[1] * gains.k_p_q, MOI[2] * gains.k_p_r)
+
+    out[0], out[1], out[2] = _body_rate_kernel(body_rate_cmd[0], body_rate_cmd[1], body_rate_cmd[2],
+                                               body_rate[0], body_rate[1], body_rate[2],
+                                               moi_k_rate[0], moi_k_rate[1], moi_k_rate[2])
+
+    return out
+
+
+def yaw_control(gains, yaw_cmd, yaw):
+    """ Generate the target yawrate
+
+    Args:
+        gains: Gains tuple
+        yaw_cmd: desired vehicle yaw in radians
+        yaw: vehicle yaw in radians
+
+    Returns: target yawrate in radians/sec
+    """
+    # wrap to [-pi, pi], whatever the magnitude of the difference
+    yaw_err = math.remainder(yaw_cmd - yaw, 2.0*math.pi)
+
+    return gains.k_p_yaw * yaw_err
+
+
+class _GainsBase(object):
+    """The control gains shared by NonlinearController and NonlinearControllerBatched
+
+    Subclasses derive whatever they precompute from the gains in _update_gains, which runs again
+    on every gain assignment.
+    """
 
     def __init__(self,
                  z_k_p=20.0,
@@ -33,7 +430,7 @@ class NonlinearController(object):
                  k_p_r=10.0,
                  max_roll_rad=1.0,
                  max_pitch_rad=1.0):
-        """Initialize the controller object and control gains"""
+        """Initialize the control gains"""
 
         self.z_k_p = z_k_p
         self.z_k_d = z_k_d
@@ -50,6 +447,83 @@ class NonlinearController(object):
         self.max_roll_rad=max_roll_rad
         self.max_pitch_rad=max_pitch_rad
 
+        self._update_gains()
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        # keep what is derived from the gains in step with them, e.g. when tuning ctrl.z_k_p = 15.0
+        if name in Gains._fields and '_gains' in self.__dict__:
+            self._update_gains()
+
+    def _update_gains(self):
+        """Rebuild the Gains tuple from the gain attributes"""
+        self._gains = self.as_pickleable_gains()
+
+    def as_pickleable_gains(self):
+        """Gains tuple of this controller, for the module level functions (e.g. in worker processes)"""
+        return Gains(self.z_k_p, self.z_k_d, self.x_k_p, self.x_k_d, self.y_k_p, self.y_k_d, self.k_p_roll,
+                     self.k_p_pitch, self.k_p_yaw, self.k_p_p, self.k_p_q, self.k_p_r, self.max_roll_rad,
+                     self.max_pitch_rad)
+
+
+class NonlinearController(_GainsBase):
+
+    def __init__(self, *args, **kwargs):
+        """Initialize the controller object and control gains, see _GainsBase for the gains and their defaults"""
+        super().__init__(*args, **kwargs)
+
+        self._time_src = None
+        self._position_src = None
+        self._time_arr = None
+        self._pos_arr = None
+        self._seg_dpos = None
+        self._inv_dt = None
+
+        # output buffers, reused on every call. The single drone path stays float64 throughout, only
+        # NonlinearControllerBatched works in float32
+        self._ne_buf = np.empty(2)
+        self._pq_buf = np.empty(2)
+        self._moment_buf = np.empty(3)
+
+    def _update_gains(self):
+        """Also rebuild the specialized step and the gain products"""
+        super()._update_gains()
+
+        # compiled on the first call to step() (again after any gain change). Without numba a
+        # specialized copy buys nothing, step() calls step_kernel directly
+        self._step = _make_step(self._gains) if numba_available else None
+
+        # MOI and the rate gains only change here, so their product is precomputed
+        self._MOI_K_rate = MOI * np.array([self.k_p_p, self.k_p_q, self.k_p_r])
+
+    def _update_attitude(self, attitude):
+        """Compute the rotation matrix of the current attitude once for this control step
+        
+        Args:
+            attitude: 3-element numpy array (roll, pitch, yaw) in radians
+            
+        Returns: the 3x3 rotation matrix, to be passed as rot_mat to altitude_control and roll_pitch_controller
+        """
+        return euler2RM(attitude[0], attitude[1], attitude[2])
+
+    def step(self, local_position, local_velocity, attitude, body_rate, local_position_cmd, local_velocity_cmd,
+             yaw_cmd, acceleration_ff):
+        """Run the whole control chain for one drone in one step_kernel call, specialized for this controller's gains
+        
+        The first call with a new set of gains compiles the specialized kernel, which stalls that call
+        for a fraction of a second: this includes the first call after a gain assignment, unless those
+        gains were used before (by any controller).
+        
+        Args: see step_kernel
+            
+        Returns: tuple (thrust command, roll moment, pitch moment, yaw moment)
+        """
+        if self._step is None:
+            return step_kernel(local_position, local_velocity, attitude, body_rate, local_position_cmd,
+                               local_velocity_cmd, yaw_cmd, acceleration_ff, self._gains)
+
+        return self._step(local_position, local_velocity, attitude, body_rate, local_position_cmd, local_velocity_cmd,
+                          yaw_cmd, acceleration_ff)
 
     def trajectory_control(self, position_trajectory, yaw_trajectory, time_trajectory, current_time):
         """Generate a commanded position, velocity and yaw based on the trajectory
@@ -64,37 +538,33 @@ class NonlinearController(object):
                 
         """
 
-        ind_min = np.argmin(np.abs(np.array(time_trajectory) - current_time))
-        time_ref = time_trajectory[ind_min]
-        
-        
-        if current_time < time_ref:
-            position0 = position_trajectory[ind_min - 1]
-            position1 = position_trajectory[ind_min]
-            
-            time0 = time_trajectory[ind_min - 1]
-            time1 = time_trajectory[ind_min]
-            yaw_cmd = yaw_trajectory[ind_min - 1]
-            
+        if time_trajectory is not self._time_src or position_trajectory is not self._position_src:
+            # trajectory changed, refresh the array copies (assumes the lists are not modified in place)
+            self._time_src = time_trajectory
+            self._position_src = position_trajectory
+            self._time_arr = np.asarray(time_trajectory, dtype=np.float64)
+            self._pos_arr = np.asarray(position_trajectory, dtype=np.float64)
+            # per segment position change and 1/duration, so interpolating needs no division
+            self._seg_dpos = np.diff(self._pos_arr, axis=0)
+            self._inv_dt = 1.0 / np.diff(self._time_arr)
+
+        # time_trajectory is increasing: index of the segment [ind, ind + 1] containing current_time
+        ind = int(np.searchsorted(self._time_arr, current_time, side='right')) - 1
+
+        if ind < 0:
+            # before the first point, hold it
+            position_cmd = self._pos_arr[0].copy()
+            velocity_cmd = np.zeros_like(position_cmd)
+            yaw_cmd = yaw_trajectory[0]
+        elif ind >= len(self._time_arr) - 1:
+            # past the last point, hold it
+            position_cmd = self._pos_arr[-1].copy()
+            velocity_cmd = np.zeros_like(position_cmd)
+            yaw_cmd = yaw_trajectory[-1]
         else:
-            yaw_cmd = yaw_trajectory[ind_min]
-            if ind_min >= len(position_trajectory) - 1:
-                position0 = position_trajectory[ind_min]
-                position1 = position_trajectory[ind_min]
-                
-                time0 = 0.0
-                time1 = 1.0
-            else:
-
-                position0 = position_trajectory[ind_min]
-                position1 = position_trajectory[ind_min + 1]
-                time0 = time_trajectory[ind_min]
-                time1 = time_trajectory[ind_min + 1]
-            
-        position_cmd = (position1 - position0) * \
-                        (current_time - time0) / (time1 - time0) + position0
-        velocity_cmd = (position1 - position0) / (time1 - time0)
-        
+            velocity_cmd = self._seg_dpos[ind] * self._inv_dt[ind]
+            position_cmd = velocity_cmd * (current_time - self._time_arr[ind]) + self._pos_arr[ind]
+            yaw_cmd = yaw_trajectory[ind]
         
         return (position_cmd, velocity_cmd, yaw_cmd)
     
@@ -110,27 +580,13 @@ class NonlinearController(object):
             acceleration_cmd: feedforward acceleration command
             
         Returns: desired vehicle 2D acceleration in the local frame [north, east]
+            (the same array is reused by the next call)
         """
-        x_cmd, y_cmd = local_position_cmd
-        x_dot_cmd, y_dot_cmd = local_velocity_cmd
-
-        x, y = local_position
-        x_dot, y_dot = local_velocity
-
-
-        x_dot_dot_acc, y_dot_dot_acc = acceleration_ff
-
-        x_dot_err = x_dot_cmd - x_dot
-        x_err = x_cmd - x
-        x_dot_dot = self.x_k_p * x_err + self.x_k_d * x_dot_err + x_dot_dot_acc
-
-        y_dot_err = y_dot_cmd - y_dot
-        y_err = y_cmd - y
-        y_dot_dot = self.x_k_p * y_err + self.y_k_d * y_dot_err + y_dot_dot_acc
-
-        return np.array([-x_dot_dot, -y_dot_dot])
+        return lateral_position_control(self._gains, local_position_cmd, local_velocity_cmd, local_position,
+                                        local_velocity, acceleration_ff, out=self._ne_buf)
     
-    def altitude_control(self, altitude_cmd, vertical_velocity_cmd, altitude, vertical_velocity, attitude, acceleration_ff=0.0):
+    def altitude_control(self, altitude_cmd, vertical_velocity_cmd, altitude, vertical_velocity, attitude,
+                         acceleration_ff=0.0, rot_mat=None):
         """Generate vertical acceleration (thrust) command
 
         Args:
@@ -140,108 +596,226 @@ class NonlinearController(object):
             vertical_velocity: vehicle vertical velocity (+up)
             attitude: the vehicle's current attitude, 3 element numpy array (roll, pitch, yaw) in radians
             acceleration_ff: feedforward acceleration command (+up)
+            rot_mat: optional rotation matrix of attitude, as returned by _update_attitude
             
         Returns: thrust command for the vehicle (+up)
         """
-        rot_mat = euler2RM(attitude[0], attitude[1], attitude[2])
-
-        z_err = altitude_cmd - altitude
-        z_err_dot = vertical_velocity_cmd - vertical_velocity
-        b_z = rot_mat[2, 2]
+        return altitude_control(self._gains, altitude_cmd, vertical_velocity_cmd, altitude, vertical_velocity, attitude,
+                                acceleration_ff, rot_mat)
 
-        p_term = self.z_k_p * z_err
-        d_term = self.z_k_d * z_err_dot
+    def altitude_control_q(self, altitude_cmd, vertical_velocity_cmd, altitude, vertical_velocity, q,
+                           acceleration_ff=0.0):
+        """Generate vertical acceleration (thrust) command from a quaternion attitude
 
-        u_1_bar = p_term + d_term + acceleration_ff
-
-        c = (u_1_bar - GRAVITY) / b_z
-
-        thrust = np.clip(c, 0.0, MAX_THRUST)
-
-        return thrust
+        Args:
+            altitude_cmd: desired vertical position (+up)
+            vertical_velocity_cmd: desired vertical velocity (+up)
+            altitude: vehicle vertical position (+up)
+            vertical_velocity: vehicle vertical velocity (+up)
+            q: the vehicle's current attitude, 4 element numpy array unit quaternion (q0, q1, q2, q3)
+            acceleration_ff: feedforward acceleration command (+up)
+            
+        Returns: thrust command for the vehicle (+up)
+        """
+        return altitude_control_q(self._gains, altitude_cmd, vertical_velocity_cmd, altitude, vertical_velocity, q,
+                                  acceleration_ff)
 
     
-    def roll_pitch_controller(self, acceleration_cmd, attitude, thrust_cmd):
+    def roll_pitch_controller(self, acceleration_cmd, attitude, thrust_cmd, rot_mat=None):
         """ Generate the rollrate and pitchrate commands in the body frame
         
         Args:
             target_acceleration: 2-element numpy array (north_acceleration_cmd,east_acceleration_cmd) in m/s^2
             attitude: 3-element numpy array (roll, pitch, yaw) in radians
             thrust_cmd: vehicle thruts command in Newton
+            rot_mat: optional rotation matrix of attitude, as returned by _update_attitude
+                or by frame_utils.quaternion2RM for a quaternion attitude (no trig call). attitude is
+                still required: the max angle check reads roll and pitch from it
             
         Returns: 2-element numpy array, desired rollrate (p) and pitchrate (q) commands in radians/s
+            (the same array is reused by the next call)
         """
-        b_x_c, b_y_c = acceleration_cmd
-
-        rot_mat = euler2RM(attitude[0], attitude[1], attitude[2])
+        return roll_pitch_controller(self._gains, acceleration_cmd, attitude, thrust_cmd, rot_mat, out=self._pq_buf)
+    
+    def roll_pitch_controller_q(self, acceleration_cmd, q, thrust_cmd):
+        """ Generate the rollrate and pitchrate commands in the body frame from a quaternion attitude error
+        
+        Args:
+            acceleration_cmd: 2-element numpy array (north_acceleration_cmd,east_acceleration_cmd) in m/s^2
+            q: 4 element numpy array unit quaternion (q0, q1, q2, q3)
+            thrust_cmd: vehicle thrust command in Newton
+            
+        Returns: 2-element numpy array, desired rollrate (p) and pitchrate (q) commands in radians/s
+            (the same array is reused by the next call)
+        """
+        return roll_pitch_controller_q(self._gains, acceleration_cmd, q, thrust_cmd, out=self._pq_buf)
+    
+    def body_rate_control(self, body_rate_cmd, body_rate):
+        """ Generate the roll, pitch, yaw moment commands in the body frame
+        
+        Args:
+            body_rate_cmd: 3-element numpy array (p_cmd,q_cmd,r_cmd) in radians/second^2
+            body_rate: 3-element numpy array (p,q,r) in radians/second^2
+            
+        Returns: 3-element numpy array, desired roll moment, pitch moment, and yaw moment commands in Newtons*meters
+            (the same array is reused by the next call)
+        """
+        return body_rate_control(self._gains, body_rate_cmd, body_rate, out=self._moment_buf,
+                                 moi_k_rate=self._MOI_K_rate)
 
-        b_x_err = b_x_c - rot_mat[0, 2]
-        b_x_p_term = self.k_p_roll * b_x_err
+    def yaw_control(self, yaw_cmd, yaw):
+        """ Generate the target yawrate
+        
+        Args:
+            yaw_cmd: desired vehicle yaw in radians
+            yaw: vehicle yaw in radians
+        
+        Returns: target yawrate in radians/sec
+        """
+        return yaw_control(self._gains, yaw_cmd, yaw)
 
-        b_y_err = b_y_c - rot_mat[1, 2]
-        b_y_p_term = self.k_p_pitch * b_y_err
 
-        rot_mat1 = np.array([[rot_mat[1, 0], -rot_mat[0, 0]], [rot_mat[1, 1], -rot_mat[0, 1]]]) / rot_mat[2, 2]
+class NonlinearControllerBatched(_GainsBase):
+    """NonlinearController operating on N drones per call
+    
+    Same gains and control laws as NonlinearController, but every state argument
+    carries a leading drone axis: attitude is (N,3), local_position is (N,2),
+    altitude is (N,) etc. Inputs are converted to float32 and results are float32.
+    step, trajectory_control and the quaternion controllers are single drone only.
+    """
 
-        rot_rate = np.matmul(rot_mat1, np.array([b_x_p_term, b_y_p_term]).T)
+    def _update_gains(self):
+        """Also rebuild the gain vectors, in float32: [north, east] position gains, [roll, pitch] gains
+        and MOI * [p, q, r] gains"""
+        super()._update_gains()
 
-        p_c = rot_rate[0]
-        q_c = rot_rate[1]
+        self._MOI_K_rate = (MOI * np.array([self.k_p_p, self.k_p_q, self.k_p_r])).astype(np.float32)
 
-        #if max angle is reached, no more rotation requested
-        if attitude[0] > self.max_roll_rad or attitude[0] < -self.max_roll_rad:
-            p_c =0.0
-        if attitude[1] > self.max_pitch_rad or attitude[1] < -self.max_pitch_rad:
-            q_c =0.0
+        self._Kp_ne = np.array([self.x_k_p, self.y_k_p], dtype=np.float32)
+        self._Kd_ne = np.array([self.x_k_d, self.y_k_d], dtype=np.float32)
+        self._K_att = np.array([self.k_p_roll, self.k_p_pitch], dtype=np.float32)
 
-        return np.array([p_c, q_c])
-    
-    def body_rate_control(self, body_rate_cmd, body_rate):
-        """ Generate the roll, pitch, yaw moment commands in the body frame
+    def _update_attitude(self, attitude):
+        """Compute the rotation matrices of the current attitudes once for this control step
         
         Args:
-            body_rate_cmd: 3-element numpy array (p_cmd,q_cmd,r_cmd) in radians/second^2
-            body_rate: 3-element numpy array (p,q,r) in radians/second^2
+            attitude: (N,3) array (roll, pitch, yaw) in radians
             
-        Returns: 3-element numpy array, desired roll moment, pitch moment, and yaw moment commands in Newtons*meters
+        Returns: (N,3,3) float32 rotation matrices, to be passed as rot_mat to altitude_control and
+            roll_pitch_controller
         """
-        p_c, q_c, r_c = body_rate_cmd
-        p_actual, q_actual, r_actual = body_rate
+        attitude = np.asarray(attitude, dtype=np.float32)
+        return euler2RM_batched(attitude[:, 0], attitude[:, 1], attitude[:, 2])
 
-        p_err = p_c - p_actual
-        u_bar_p = self.k_p_p * p_err
+    def lateral_position_control(self, local_position_cmd, local_velocity_cmd, local_position, local_velocity,
+                               acceleration_ff = np.array([0.0, 0.0], dtype=np.float32)):
+        """Generate horizontal acceleration commands for N vehicles in the local frame
 
-        q_err = q_c - q_actual
-        u_bar_q = self.k_p_q * q_err
+        Args:
+            local_position_cmd: (N,2) desired positions in local frame [north, east]
+            local_velocity_cmd: (N,2) desired velocities in local frame [north_velocity, east_velocity]
+            local_position: (N,2) vehicle positions in the local frame [north, east]
+            local_velocity: (N,2) vehicle velocities in the local frame [north_velocity, east_velocity]
+            acceleration_ff: (N,2) or (2,) feedforward acceleration command
+            
+        Returns: (N,2) desired vehicle accelerations in the local frame [north, east]
+        """
+        err = np.asarray(local_position_cmd, dtype=np.float32) - np.asarray(local_position, dtype=np.float32)
+        err_dot = np.asarray(local_velocity_cmd, dtype=np.float32) - np.asarray(local_velocity, dtype=np.float32)
 
-        r_err = r_c - r_actual
-        u_bar_r = self.k_p_r * r_err
+        return -(self._Kp_ne * err + self._Kd_ne * err_dot + np.asarray(acceleration_ff, dtype=np.float32))
 
-        moment_cmd = np.multiply(MOI, np.array([u_bar_p, u_bar_q, u_bar_r]).T)
+    def altitude_control(self, altitude_cmd, vertical_velocity_cmd, altitude, vertical_velocity, attitude,
+                         acceleration_ff=0.0, rot_mat=None):
+        """Generate vertical acceleration (thrust) commands for N vehicles
 
-        if np.linalg.norm(moment_cmd) > MAX_TORQUE:
-            moment_cmd = moment_cmd*MAX_TORQUE/np.linalg.norm(moment_cmd)
+        Args:
+            altitude_cmd: (N,) desired vertical positions (+up)
+            vertical_velocity_cmd: (N,) desired vertical velocities (+up)
+            altitude: (N,) vehicle vertical positions (+up)
+            vertical_velocity: (N,) vehicle vertical velocities (+up)
+            attitude: (N,3) vehicle attitudes (roll, pitch, yaw) in radians
+            acceleration_ff: (N,) or scalar feedforward acceleration command (+up)
+            rot_mat: optional (N,3,3) rotation matrices of attitude, as returned by _update_attitude
+            
+        Returns: (N,) thrust commands (+up)
+        """
+        if rot_mat is None:
+            # only rot_mat[:, 2, 2] of euler2RM_batched is needed
+            attitude = np.asarray(attitude, dtype=np.float32)
+            b_z = np.cos(attitude[:, 0]) * np.cos(attitude[:, 1])
+        else:
+            b_z = rot_mat[:, 2, 2]
 
-        return moment_cmd
+        z_err = np.asarray(altitude_cmd, dtype=np.float32) - np.asarray(altitude, dtype=np.float32)
+        z_err_dot = (np.asarray(vertical_velocity_cmd, dtype=np.float32) -
+                     np.asarray(vertical_velocity, dtype=np.float32))
 
-    def yaw_control(self, yaw_cmd, yaw):
-        """ Generate the target yawrate
+        u_1_bar = (self._gains.z_k_p * z_err + self._gains.z_k_d * z_err_dot +
+                   np.asarray(acceleration_ff, dtype=np.float32))
+
+        c = (u_1_bar - GRAVITY) / b_z
+
+        return np.clip(c, 0.0, MAX_THRUST)
+
+    def roll_pitch_controller(self, acceleration_cmd, attitude, thrust_cmd, rot_mat=None):
+        """ Generate the rollrate and pitchrate commands in the body frame for N vehicles
         
         Args:
-            yaw_cmd: desired vehicle yaw in radians
-            yaw: vehicle yaw in radians
+            acceleration_cmd: (N,2) array (north_acceleration_cmd,east_acceleration_cmd) in m/s^2
+            attitude: (N,3) array (roll, pitch, yaw) in radians
+            thrust_cmd: (N,) vehicle thrust commands in Newton
+            rot_mat: optional (N,3,3) rotation matrices of attitude, as returned by _update_attitude
+            
+        Returns: (N,2) array, desired rollrate (p) and pitchrate (q) commands in radians/s
+        """
+        attitude = np.asarray(attitude, dtype=np.float32)
+        if rot_mat is None:
+            rot_mat = euler2RM_batched(attitude[:, 0], attitude[:, 1], attitude[:, 2])
+
+        b_err = np.asarray(acceleration_cmd, dtype=np.float32) - rot_mat[:, 0:2, 2]
+        bp_terms = self._K_att * b_err
+
+        # [[r10, -r00], [r11, -r01]] / r22 times the p terms, one column op per entry instead of
+        # stacking (N,2,2) matrices for einsum
+        inv_b_z = 1.0 / rot_mat[:, 2, 2]
+        rot_rate = np.empty_like(bp_terms)
+        rot_rate[:, 0] = (rot_mat[:, 1, 0] * bp_terms[:, 0] - rot_mat[:, 0, 0] * bp_terms[:, 1]) * inv_b_z
+        rot_rate[:, 1] = (rot_mat[:, 1, 1] * bp_terms[:, 0] - rot_mat[:, 0, 1] * bp_terms[:, 1]) * inv_b_z
+
+        #if max angle is reached, no more rotation requested
+        rot_rate[:, 0] = np.where(np.abs(attitude[:, 0]) > self._gains.max_roll_rad, 0.0, rot_rate[:, 0])
+        rot_rate[:, 1] = np.where(np.abs(attitude[:, 1]) > self._gains.max_pitch_rad, 0.0, rot_rate[:, 1])
+
+        return rot_rate
+
+    def body_rate_control(self, body_rate_cmd, body_rate):
+        """ Generate the roll, pitch, yaw moment commands in the body frame for N vehicles
         
-        Returns: target yawrate in radians/sec
+        Args:
+            body_rate_cmd: (N,3) array (p_cmd,q_cmd,r_cmd) in radians/second^2
+            body_rate: (N,3) array (p,q,r) in radians/second^2
+            
+        Returns: (N,3) array, desired roll moment, pitch moment, and yaw moment commands in Newtons*meters
         """
+        moment_cmd = self._MOI_K_rate * (np.asarray(body_rate_cmd, dtype=np.float32) -
+                                         np.asarray(body_rate, dtype=np.float32))
 
-        yaw_err = yaw_cmd - yaw
-        if yaw_err > np.pi:
-            yaw_err = yaw_err - 2.0*np.pi
-        elif yaw_err < -np.pi:
-            yaw_err = yaw_err + 2.0*np.pi
+        # scale = min(1, MAX_TORQUE/norm), written to avoid dividing by a zero norm
+        norm = np.linalg.norm(moment_cmd, axis=1, keepdims=True)
 
-        r_c = self.k_p_yaw * yaw_err
+        return moment_cmd * (MAX_TORQUE / np.maximum(norm, MAX_TORQUE))
 
-        return r_c
+    def yaw_control(self, yaw_cmd, yaw):
+        """ Generate the target yawrates for N vehicles
+        
+        Args:
+            yaw_cmd: (N,) desired vehicle yaws in radians
+            yaw: (N,) vehicle yaws in radians
+        
+        Returns: (N,) target yawrates in radians/sec
+        """
+        yaw_err = np.asarray(yaw_cmd, dtype=np.float32) - np.asarray(yaw, dtype=np.float32)
+        yaw_err = np.remainder(yaw_err + np.pi, 2.0*np.pi) - np.pi
 
-    
+        return self._gains.k_p_yaw * yaw_err
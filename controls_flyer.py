@@ -68,17 +68,20 @@ class ControlsFlyer(UnityDrone):
                                                    0.0])
         
     def attitude_controller(self):
+        rot_mat = self.controller._update_attitude(self.attitude)
         self.thrust_cmd = self.controller.altitude_control(
                 -self.local_position_target[2],
                 -self.local_velocity_target[2],
                 -self.local_position[2],
                 -self.local_velocity[2],
                 self.attitude,
-                9.81)
+                9.81,
+                rot_mat=rot_mat)
         roll_pitch_rate_cmd = self.controller.roll_pitch_controller(
                 self.local_acceleration_target[0:2],
                 self.attitude,
-                self.thrust_cmd)
+                self.thrust_cmd,
+                rot_mat=rot_mat)
         yawrate_cmd = self.controller.yaw_control(
                 self.attitude_target[2],
                 self.attitude[2])
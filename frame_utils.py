@@ -1,16 +1,19 @@
 # -*- coding: utf-8 -*-
+import math
+
 import numpy as np
 
 def euler2RM(roll,pitch,yaw):
     R = np.array([[0.0,0.0,0.0],[0.0,0.0,0.0],[0.0,0.0,0.0]])
-    cr = np.cos(roll)
-    sr = np.sin(roll)
+    # scalar angles: math is much cheaper than the numpy ufuncs here
+    cr = math.cos(roll)
+    sr = math.sin(roll)
     
-    cp = np.cos(pitch)
-    sp = np.sin(pitch)
+    cp = math.cos(pitch)
+    sp = math.sin(pitch)
     
-    cy = np.cos(yaw)
-    sy = np.sin(yaw)
+    cy = math.cos(yaw)
+    sy = math.sin(yaw)
     
     R[0,0] = cp*cy
     R[1,0] = -cr*sy+sr*sp*cy
@@ -24,4 +27,70 @@ def euler2RM(roll,pitch,yaw):
     R[1,2] = sr*cp
     R[2,2] = cr*cp
     
-    return R.transpose()
\ No newline at end of file
+    return R.transpose()
+
+
+def euler2RM_batched(roll,pitch,yaw):
+    """Batched euler2RM: roll, pitch, yaw are (N,) arrays, returns (N,3,3)"""
+    cr = np.cos(roll)
+    sr = np.sin(roll)
+    
+    cp = np.cos(pitch)
+    sp = np.sin(pitch)
+    
+    cy = np.cos(yaw)
+    sy = np.sin(yaw)
+    
+    R = np.empty((np.shape(roll)[0], 3, 3), dtype=cr.dtype)
+    
+    # same entries as euler2RM, already transposed
+    R[:,0,0] = cp*cy
+    R[:,0,1] = -cr*sy+sr*sp*cy
+    R[:,0,2] = sr*sy+cr*sp*cy
+    
+    R[:,1,0] = cp*sy
+    R[:,1,1] = cr*cy+sr*sp*sy
+    R[:,1,2] = -sr*cy+cr*sp*sy
+    
+    R[:,2,0] = -sp
+    R[:,2,1] = sr*cp
+    R[:,2,2] = cr*cp
+    
+    return R
+
+
+def euler2quaternion(roll,pitch,yaw):
+    """Unit quaternion (q0,q1,q2,q3), scalar first, of the same rotation as euler2RM"""
+    cr = math.cos(roll/2.0)
+    sr = math.sin(roll/2.0)
+    
+    cp = math.cos(pitch/2.0)
+    sp = math.sin(pitch/2.0)
+    
+    cy = math.cos(yaw/2.0)
+    sy = math.sin(yaw/2.0)
+    
+    return np.array([cr*cp*cy+sr*sp*sy,
+                     sr*cp*cy-cr*sp*sy,
+                     cr*sp*cy+sr*cp*sy,
+                     cr*cp*sy-sr*sp*cy])
+
+
+def quaternion2RM(q):
+    """Same matrix as euler2RM, built from a unit quaternion without any trig call"""
+    q0, q1, q2, q3 = q
+    R = np.empty((3, 3))
+    
+    R[0,0] = 1.0-2.0*(q2*q2+q3*q3)
+    R[0,1] = 2.0*(q1*q2-q0*q3)
+    R[0,2] = 2.0*(q1*q3+q0*q2)
+    
+    R[1,0] = 2.0*(q1*q2+q0*q3)
+    R[1,1] = 1.0-2.0*(q1*q1+q3*q3)
+    R[1,2] = 2.0*(q2*q3-q0*q1)
+    
+    R[2,0] = 2.0*(q1*q3-q0*q2)
+    R[2,1] = 2.0*(q2*q3+q0*q1)
+    R[2,2] = 1.0-2.0*(q1*q1+q2*q2)
+    
+    return R
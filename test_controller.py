@@ -0,0 +1,365 @@
+"""
+Equivalence checks between the controller implementations
+
+Run with pytest, or directly: python test_controller.py
+"""
+import os
+
+import numpy as np
+import pytest
+
+from controller import NonlinearController, NonlinearControllerBatched, control_step, numba_available
+from frame_utils import euler2RM, euler2quaternion, quaternion2RM
+
+N = 64
+GAINS = dict(z_k_p=18.0, z_k_d=5.0, x_k_p=0.3, x_k_d=0.2, y_k_p=0.4, y_k_d=0.35,
+             k_p_roll=3.0, k_p_pitch=5.0, k_p_yaw=4.0, k_p_p=25.0, k_p_q=30.0, k_p_r=8.0,
+             max_roll_rad=0.6, max_pitch_rad=0.7)
+
+
+def _states(seed=0):
+    rng = np.random.default_rng(seed)
+    attitude = rng.uniform(-0.8, 0.8, (N, 3))
+    attitude[:, 2] = rng.uniform(-np.pi, np.pi, N)
+    return dict(position_cmd=rng.uniform(-5.0, 5.0, (N, 3)),
+                velocity_cmd=rng.uniform(-2.0, 2.0, (N, 3)),
+                position=rng.uniform(-5.0, 5.0, (N, 3)),
+                velocity=rng.uniform(-2.0, 2.0, (N, 3)),
+                attitude=attitude,
+                body_rate=rng.uniform(-1.0, 1.0, (N, 3)),
+                acceleration_cmd=rng.uniform(-0.5, 0.5, (N, 2)),
+                body_rate_cmd=rng.uniform(-1.0, 1.0, (N, 3)),
+                yaw_cmd=rng.uniform(-np.pi, np.pi, N))
+
+
+def _check_batched_matches_scalar(scalar, batched):
+    s = _states()
+
+    lateral = batched.lateral_position_control(s['position_cmd'][:, :2], s['velocity_cmd'][:, :2],
+                                               s['position'][:, :2], s['velocity'][:, :2])
+    thrust = batched.altitude_control(s['position_cmd'][:, 2], s['velocity_cmd'][:, 2], s['position'][:, 2],
+                                      s['velocity'][:, 2], s['attitude'])
+    pq = batched.roll_pitch_controller(s['acceleration_cmd'], s['attitude'], thrust)
+    moment = batched.body_rate_control(s['body_rate_cmd'], s['body_rate'])
+    yaw_rate = batched.yaw_control(s['yaw_cmd'], s['attitude'][:, 2])
+
+    for i in range(N):
+        np.testing.assert_allclose(lateral[i], scalar.lateral_position_control(
+            s['position_cmd'][i, :2], s['velocity_cmd'][i, :2], s['position'][i, :2], s['velocity'][i, :2]),
+            rtol=1e-5, atol=1e-5)
+        np.testing.assert_allclose(thrust[i], scalar.altitude_control(
+            s['position_cmd'][i, 2], s['velocity_cmd'][i, 2], s['position'][i, 2], s['velocity'][i, 2],
+            s['attitude'][i]), rtol=1e-5, atol=1e-5)
+        np.testing.assert_allclose(pq[i], scalar.roll_pitch_controller(
+            s['acceleration_cmd'][i], s['attitude'][i], thrust[i]), rtol=1e-4, atol=1e-5)
+        np.testing.assert_allclose(moment[i], scalar.body_rate_control(s['body_rate_cmd'][i], s['body_rate'][i]),
+                                   rtol=1e-5, atol=1e-6)
+        np.testing.assert_allclose(yaw_rate[i], scalar.yaw_control(s['yaw_cmd'][i], s['attitude'][i, 2]),
+                                   rtol=1e-5, atol=1e-5)
+
+
+def test_batched_matches_scalar():
+    """NonlinearControllerBatched gives, per drone, what NonlinearController gives (to float32 precision)"""
+    _check_batched_matches_scalar(NonlinearController(**GAINS), NonlinearControllerBatched(**GAINS))
+
+
+def test_batched_rot_mat_once_per_step():
+    """The batched methods give the same results from the rotation matrices of _update_attitude"""
+    batched = NonlinearControllerBatched(**GAINS)
+    s = _states()
+    rot_mat = batched._update_attitude(s['attitude'])
+    assert rot_mat.shape == (N, 3, 3) and rot_mat.dtype == np.float32
+
+    thrust = batched.altitude_control(s['position_cmd'][:, 2], s['velocity_cmd'][:, 2], s['position'][:, 2],
+                                      s['velocity'][:, 2], s['attitude'])
+    np.testing.assert_allclose(batched.altitude_control(s['position_cmd'][:, 2], s['velocity_cmd'][:, 2],
+                                                        s['position'][:, 2], s['velocity'][:, 2], s['attitude'],
+                                                        rot_mat=rot_mat), thrust, rtol=1e-5)
+    np.testing.assert_allclose(batched.roll_pitch_controller(s['acceleration_cmd'], s['attitude'], thrust,
+                                                             rot_mat=rot_mat),
+                               batched.roll_pitch_controller(s['acceleration_cmd'], s['attitude'], thrust),
+                               rtol=1e-5, atol=1e-6)
+
+
+def test_step_matches_chained_methods():
+    """step, and control_step in worker processes, give what chaining the methods as ControlsFlyer does gives"""
+    ctrl = NonlinearController(**GAINS)
+    s = _states(1)
+    acceleration_ff = np.array([0.1, -0.2, 9.81])
+
+    for i in range(N):
+        acceleration_cmd = ctrl.lateral_position_control(s['position_cmd'][i, :2], s['velocity_cmd'][i, :2],
+                                                         s['position'][i, :2], s['velocity'][i, :2],
+                                                         acceleration_ff[:2]).copy()
+        thrust = ctrl.altitude_control(-s['position_cmd'][i, 2], -s['velocity_cmd'][i, 2], -s['position'][i, 2],
+                                       -s['velocity'][i, 2], s['attitude'][i], acceleration_ff[2])
+        pq = ctrl.roll_pitch_controller(acceleration_cmd, s['attitude'][i], thrust)
+        yaw_rate = ctrl.yaw_control(s['yaw_cmd'][i], s['attitude'][i, 2])
+        moment = ctrl.body_rate_control(np.array([pq[0], pq[1], yaw_rate]), s['body_rate'][i])
+
+        state = (s['position'][i], s['velocity'][i], s['attitude'][i], s['body_rate'][i], s['position_cmd'][i],
+                 s['velocity_cmd'][i], s['yaw_cmd'][i], acceleration_ff)
+        np.testing.assert_allclose(ctrl.step(*state), [thrust, *moment], rtol=1e-9, atol=1e-12)
+        np.testing.assert_allclose(control_step(ctrl.as_pickleable_gains(), state), [thrust, *moment],
+                                   rtol=1e-9, atol=1e-12)
+
+
+def test_quaternion_attitude_matches_euler():
+    """quaternion2RM and altitude_control_q agree with euler2RM and altitude_control for the same attitude"""
+    ctrl = NonlinearController(**GAINS)
+    s = _states(3)
+
+    for i in range(N):
+        attitude = s['attitude'][i]
+        q = euler2quaternion(*attitude)
+        np.testing.assert_allclose(quaternion2RM(q), euler2RM(*attitude), atol=1e-12)
+
+        # small altitude errors and a feedforward offsetting most of gravity, so the thrust is not clipped
+        altitude_cmd = s['position'][i, 2] + 0.01 * s['position_cmd'][i, 2]
+        thrust = ctrl.altitude_control(altitude_cmd, 0.0, s['position'][i, 2], 0.05 * s['velocity'][i, 2], attitude,
+                                       -7.0)
+        assert 0.0 < thrust < 10.0
+        np.testing.assert_allclose(
+            ctrl.altitude_control_q(altitude_cmd, 0.0, s['position'][i, 2], 0.05 * s['velocity'][i, 2], q, -7.0),
+            thrust, rtol=1e-12)
+
+
+def test_roll_pitch_q_matches_euler_near_level():
+    """With unequal roll and pitch gains, roll_pitch_controller_q puts them on the same axes as
+    roll_pitch_controller: the two agree for small tilts and errors, whatever the yaw"""
+    ctrl = NonlinearController(**GAINS)
+    rng = np.random.default_rng(2)
+
+    for _ in range(N):
+        attitude = np.array([*rng.uniform(-0.05, 0.05, 2), rng.uniform(-np.pi, np.pi)])
+        acceleration_cmd = euler2RM(*attitude)[0:2, 2] + rng.uniform(-0.01, 0.01, 2)
+
+        pq = ctrl.roll_pitch_controller(acceleration_cmd, attitude, 1.0).copy()
+        pq_q = ctrl.roll_pitch_controller_q(acceleration_cmd, euler2quaternion(*attitude), 1.0)
+        assert np.linalg.norm(pq_q - pq) < 0.01 * np.linalg.norm(pq)
+
+
+def test_yaw_control_wraps_large_differences():
+    """Yaw differences of several turns wrap to [-pi, pi] on the scalar, batched and step paths"""
+    ctrl = NonlinearController(**GAINS)
+    batched = NonlinearControllerBatched(**GAINS)
+    zeros = np.zeros(3)
+    yaw_cmd = np.array([10.0*np.pi + 0.1, -10.0*np.pi - 0.1, 7.0*np.pi - 0.2])
+    yaw = np.array([0.0, 0.0, 4.0*np.pi])
+    expected = GAINS['k_p_yaw'] * np.array([0.1, -0.1, np.pi - 0.2])
+
+    for i in range(len(yaw)):
+        np.testing.assert_allclose(ctrl.yaw_control(yaw_cmd[i], yaw[i]), expected[i], rtol=1e-9)
+
+        # yaw rate error only: no attitude, position or body rate error, so the yaw moment is MOI[2] * k_p_r * r_c
+        _, m_p, m_q, m_r = ctrl.step(zeros, zeros, np.array([0.0, 0.0, yaw[i]]), zeros, zeros, zeros, yaw_cmd[i],
+                                     np.array([0.0, 0.0, 0.0]))
+        np.testing.assert_allclose(m_r, 0.01 * GAINS['k_p_r'] * expected[i], rtol=1e-9)
+
+    np.testing.assert_allclose(batched.yaw_control(yaw_cmd, yaw), expected, rtol=1e-5)
+
+
+def _baseline_trajectory_control(position_trajectory, yaw_trajectory, time_trajectory, current_time):
+    """trajectory_control as it was before the searchsorted lookup, for times from the first point on"""
+    ind_min = np.argmin(np.abs(np.array(time_trajectory) - current_time))
+    time_ref = time_trajectory[ind_min]
+
+    if current_time < time_ref:
+        position0 = position_trajectory[ind_min - 1]
+        position1 = position_trajectory[ind_min]
+        time0 = time_trajectory[ind_min - 1]
+        time1 = time_trajectory[ind_min]
+        yaw_cmd = yaw_trajectory[ind_min - 1]
+    else:
+        yaw_cmd = yaw_trajectory[ind_min]
+        if ind_min >= len(position_trajectory) - 1:
+            position0 = position_trajectory[ind_min]
+            position1 = position_trajectory[ind_min]
+            time0 = 0.0
+            time1 = 1.0
+        else:
+            position0 = position_trajectory[ind_min]
+            position1 = position_trajectory[ind_min + 1]
+            time0 = time_trajectory[ind_min]
+            time1 = time_trajectory[ind_min + 1]
+
+    position_cmd = (position1 - position0) * (current_time - time0) / (time1 - time0) + position0
+    velocity_cmd = (position1 - position0) / (time1 - time0)
+
+    return (position_cmd, velocity_cmd, yaw_cmd)
+
+
+def test_trajectory_control_matches_baseline():
+    """trajectory_control follows test_trajectory.txt as the original lookup did, at and between the
+    points and past the end, and holds the first point before the start"""
+    ctrl = NonlinearController()
+    data = np.loadtxt(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_trajectory.txt'), delimiter=',')
+    start = 1.5e9
+    time_trajectory = list(data[:, 0] * 0.5 + start)
+    position_trajectory = list(data[:, 1:4])
+    yaw_trajectory = list(np.arange(len(data)) * 0.01)
+
+    times = np.concatenate([time_trajectory, np.linspace(time_trajectory[0], time_trajectory[-1] + 2.0, 1000)])
+    for current_time in times:
+        for actual, expected in zip(
+                ctrl.trajectory_control(position_trajectory, yaw_trajectory, time_trajectory, current_time),
+                _baseline_trajectory_control(position_trajectory, yaw_trajectory, time_trajectory, current_time)):
+            np.testing.assert_allclose(actual, expected, rtol=1e-12, atol=1e-12)
+
+    position_cmd, velocity_cmd, yaw_cmd = ctrl.trajectory_control(position_trajectory, yaw_trajectory,
+                                                                  time_trajectory, start - 5.0)
+    np.testing.assert_array_equal(position_cmd, position_trajectory[0])
+    np.testing.assert_array_equal(velocity_cmd, np.zeros(3))
+    assert yaw_cmd == yaw_trajectory[0]
+
+    # a single point trajectory is held on both sides of its time
+    for current_time in (start - 1.0, start, start + 1.0):
+        position_cmd, velocity_cmd, yaw_cmd = ctrl.trajectory_control([np.array([1.0, 2.0, 3.0])], [0.5], [start],
+                                                                      current_time)
+        np.testing.assert_array_equal(position_cmd, [1.0, 2.0, 3.0])
+        np.testing.assert_array_equal(velocity_cmd, np.zeros(3))
+        assert yaw_cmd == 0.5
+
+
+def _torch_batched_outputs(ctrl, s, torch=None):
+    """The five control outputs of a batched controller, from tensors when torch is given"""
+    def arg(value):
+        return torch.as_tensor(value, dtype=torch.float64) if torch is not None else value
+
+    attitude = arg(s['attitude'])
+    thrust = ctrl.altitude_control(arg(s['position_cmd'][:, 2]), arg(s['velocity_cmd'][:, 2]),
+                                   arg(s['position'][:, 2]), arg(s['velocity'][:, 2]), attitude,
+                                   arg(np.full(len(s['attitude']), -7.0)))
+    outputs = (ctrl.lateral_position_control(arg(s['position_cmd'][:, :2]), arg(s['velocity_cmd'][:, :2]),
+                                             arg(s['position'][:, :2]), arg(s['velocity'][:, :2])),
+               thrust,
+               ctrl.roll_pitch_controller(arg(s['acceleration_cmd']), attitude, thrust),
+               ctrl.body_rate_control(arg(s['body_rate_cmd']), arg(s['body_rate'])),
+               ctrl.yaw_control(arg(s['yaw_cmd']), attitude[:, 2]))
+
+    return [np.asarray(output) for output in outputs]
+
+
+def test_torch_matches_batched():
+    """TorchController in float64 on the CPU gives what NonlinearControllerBatched gives, with shared gains
+    (also after changing them), with per drone gains, and with zero moments"""
+    torch = pytest.importorskip('torch')
+    from torch_controller import TorchController
+
+    s = _states(4)
+    # small altitude errors, so the thrust is not clipped (with the -7 feedforward)
+    s['position_cmd'][:, 2] = s['position'][:, 2] + 0.01 * s['position_cmd'][:, 2]
+    s['velocity_cmd'][:, 2] *= 0.05
+    s['velocity'][:, 2] *= 0.05
+    # no rate error on the first drones: zero moments, MAX_TORQUE / 0 in the saturation
+    s['body_rate_cmd'][:4] = s['body_rate'][:4]
+
+    ctrl = TorchController(device='cpu', dtype=torch.float64, **GAINS)
+    batched = NonlinearControllerBatched(**GAINS)
+    for _ in range(2):
+        for actual, expected in zip(_torch_batched_outputs(ctrl, s, torch), _torch_batched_outputs(batched, s)):
+            np.testing.assert_allclose(actual, expected, rtol=1e-4, atol=1e-5)
+        for name, value in (('x_k_p', 0.1), ('z_k_d', 3.0), ('k_p_roll', 6.0), ('k_p_r', 5.0), ('k_p_yaw', 2.0),
+                            ('max_pitch_rad', 0.4)):
+            setattr(ctrl, name, value)
+            setattr(batched, name, value)
+    np.testing.assert_array_equal(_torch_batched_outputs(ctrl, s, torch)[3][:4], np.zeros((4, 3)))
+
+    # per drone gains: drone i of the swarm against a batched controller with drone i's gains
+    rng = np.random.default_rng(5)
+    per_drone = {name: value * rng.uniform(0.5, 1.5, N) for name, value in GAINS.items()}
+    outputs = _torch_batched_outputs(TorchController(device='cpu', dtype=torch.float64, **per_drone), s, torch)
+    for i in range(0, N, 8):
+        one = {name: value[i:i + 1] for name, value in s.items()}
+        expected = _torch_batched_outputs(NonlinearControllerBatched(**{name: value[i] for name, value
+                                                                        in per_drone.items()}), one)
+        for actual, expected_one in zip(outputs, expected):
+            np.testing.assert_allclose(actual[i:i + 1], expected_one, rtol=1e-4, atol=1e-5)
+
+
+def test_batched_single_drone_only():
+    """NonlinearControllerBatched has no single drone methods to misread (N,...) arrays with"""
+    batched = NonlinearControllerBatched()
+    for name in ('step', 'trajectory_control', 'altitude_control_q', 'roll_pitch_controller_q'):
+        assert not hasattr(batched, name), name
+
+
+def test_scalar_path_is_float64():
+    """float32 is confined to the batched controller: the single drone results keep float64 precision"""
+    ctrl = NonlinearController(**GAINS)
+    moment = ctrl.body_rate_control(np.array([0.9, 0.0, 0.0]), np.zeros(3))
+    assert moment.dtype == np.float64
+    assert abs(moment[0] - 0.005 * 25.0 * 0.9) < 1e-15
+    assert ctrl.lateral_position_control(np.ones(2), np.zeros(2), np.zeros(2), np.zeros(2)).dtype == np.float64
+    assert ctrl.roll_pitch_controller(np.full(2, 0.1), np.zeros(3), 1.0).dtype == np.float64
+
+
+def test_batched_path_is_float32():
+    """NonlinearControllerBatched returns float32 whatever the precision of its inputs, feedforward included"""
+    batched = NonlinearControllerBatched(**GAINS)
+    s = _states()
+    rot_mat = batched._update_attitude(s['attitude'])
+
+    outputs = (batched.lateral_position_control(s['position_cmd'][:, :2], s['velocity_cmd'][:, :2],
+                                                s['position'][:, :2], s['velocity'][:, :2], np.full((N, 2), 0.1)),
+               batched.altitude_control(s['position_cmd'][:, 2], s['velocity_cmd'][:, 2], s['position'][:, 2],
+                                        s['velocity'][:, 2], s['attitude'], np.full(N, 9.81)),
+               batched.altitude_control(s['position_cmd'][:, 2], s['velocity_cmd'][:, 2], s['position'][:, 2],
+                                        s['velocity'][:, 2], s['attitude'], 9.81, rot_mat=rot_mat),
+               batched.roll_pitch_controller(s['acceleration_cmd'], s['attitude'], np.ones(N), rot_mat=rot_mat),
+               batched.body_rate_control(s['body_rate_cmd'], s['body_rate']),
+               batched.yaw_control(s['yaw_cmd'], s['attitude'][:, 2]))
+    for output in outputs:
+        assert output.dtype == np.float32
+
+
+def test_gain_change_after_construction():
+    """Assigning a gain attribute takes effect on the next call, including the specialized step"""
+    ctrl = NonlinearController(**GAINS)
+    zeros = np.zeros(3)
+    assert ctrl.altitude_control(10.0, 0.0, 0.0, 0.0, zeros, -9.81) > 0.0
+    ctrl.z_k_p = 0.0
+    assert ctrl.altitude_control(10.0, 0.0, 0.0, 0.0, zeros, -9.81) == 0.0
+
+    ctrl.k_p_p = 0.0
+    np.testing.assert_allclose(ctrl.body_rate_control(np.array([1.0, 0.0, 0.0]), zeros), zeros)
+    thrust, m_p, m_q, m_r = ctrl.step(zeros, zeros, zeros, zeros, np.array([0.0, 0.0, -10.0]), zeros, 0.0,
+                                      np.array([0.0, 0.0, -9.81]))
+    assert thrust == 0.0
+    assert ctrl.as_pickleable_gains() == ctrl._gains
+
+
+def test_specialized_step_shared_per_gains():
+    """Controllers with the same gains share one compiled step, and reverting a gain reuses the earlier one"""
+    if not numba_available:
+        pytest.skip("no specialized step without numba")
+    ctrl = NonlinearController(**GAINS)
+    assert NonlinearController(**GAINS)._step is ctrl._step
+
+    step = ctrl._step
+    ctrl.k_p_yaw = 1.0
+    assert ctrl._step is not step
+    ctrl.k_p_yaw = GAINS['k_p_yaw']
+    assert ctrl._step is step
+
+
+def test_batched_gain_change_after_construction():
+    """A gain changed on the batched controller reaches every channel, as on the scalar one"""
+    scalar = NonlinearController(**GAINS)
+    batched = NonlinearControllerBatched(**GAINS)
+    for name, value in (('y_k_p', 0.1), ('z_k_p', 12.0), ('k_p_pitch', 2.0), ('k_p_yaw', 1.5), ('k_p_q', 20.0),
+                        ('max_roll_rad', 0.3)):
+        setattr(scalar, name, value)
+        setattr(batched, name, value)
+    _check_batched_matches_scalar(scalar, batched)
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith('test_') and callable(func):
+            try:
+                func()
+            except pytest.skip.Exception as skip:
+                print(name, 'skipped:', skip)
+                continue
+            print(name, 'ok')
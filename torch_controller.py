@@ -0,0 +1,217 @@
+"""
+PID Controller on PyTorch tensors
+
+Same control laws as controller.NonlinearControllerBatched, for swarms of N drones
+whose state tensors stay on the GPU between control steps. Gains can be scalars
+(shared by all drones) or (N,) per-drone values.
+"""
+import math
+
+import torch
+
+from controller import GRAVITY, MOI, MAX_THRUST, MAX_TORQUE, Gains
+
+
+@torch.compile(dynamic=True)
+def euler2RM_torch(roll, pitch, yaw):
+    """Batched euler2RM on tensors: roll, pitch, yaw are (N,), returns (N,3,3)"""
+    cr = torch.cos(roll)
+    sr = torch.sin(roll)
+
+    cp = torch.cos(pitch)
+    sp = torch.sin(pitch)
+
+    cy = torch.cos(yaw)
+    sy = torch.sin(yaw)
+
+    return torch.stack([torch.stack([cp*cy, -cr*sy+sr*sp*cy, sr*sy+cr*sp*cy], dim=-1),
+                        torch.stack([cp*sy, cr*cy+sr*sp*sy, -sr*cy+cr*sp*sy], dim=-1),
+                        torch.stack([-sp, sr*cp, cr*cp], dim=-1)], dim=-2)
+
+
+@torch.compile(dynamic=True)
+def _altitude_kernel(altitude_cmd, vertical_velocity_cmd, altitude, vertical_velocity, b_z, acceleration_ff,
+                     z_k_p, z_k_d, gravity: float, max_thrust: float):
+    u_1_bar = z_k_p * (altitude_cmd - altitude) + z_k_d * (vertical_velocity_cmd - vertical_velocity) + acceleration_ff
+
+    return torch.clamp((u_1_bar - gravity) / b_z, 0.0, max_thrust)
+
+
+@torch.compile(dynamic=True)
+def _roll_pitch_kernel(acceleration_cmd, attitude, rot_mat, k_att, max_roll_rad, max_pitch_rad):
+    bp_terms = k_att * (acceleration_cmd - rot_mat[:, 0:2, 2])
+    inv_b_z = 1.0 / rot_mat[:, 2, 2]
+
+    p_c = (rot_mat[:, 1, 0] * bp_terms[:, 0] - rot_mat[:, 0, 0] * bp_terms[:, 1]) * inv_b_z
+    q_c = (rot_mat[:, 1, 1] * bp_terms[:, 0] - rot_mat[:, 0, 1] * bp_terms[:, 1]) * inv_b_z
+
+    #if max angle is reached, no more rotation requested
+    p_c = torch.where(torch.abs(attitude[:, 0]) > max_roll_rad, torch.zeros_like(p_c), p_c)
+    q_c = torch.where(torch.abs(attitude[:, 1]) > max_pitch_rad, torch.zeros_like(q_c), q_c)
+
+    return torch.stack([p_c, q_c], dim=-1)
+
+
+@torch.compile(dynamic=True)
+def _body_rate_kernel(body_rate_cmd, body_rate, moi_k_rate, max_torque: float):
+    moment_cmd = moi_k_rate * (body_rate_cmd - body_rate)
+    norm = torch.linalg.vector_norm(moment_cmd, dim=1, keepdim=True)
+
+    return moment_cmd * torch.clamp(max_torque / norm, max=1.0)
+
+
+class TorchController(object):
+
+    def __init__(self,
+                 z_k_p=20.0,
+                 z_k_d=6.0,
+                 x_k_p=0.25,
+                 x_k_d=0.25,
+                 y_k_p=0.25,
+                 y_k_d=0.25,
+                 k_p_roll=4.0,
+                 k_p_pitch=4.0,
+                 k_p_yaw=5.0,
+                 k_p_p=27.0,
+                 k_p_q=27.0,
+                 k_p_r=10.0,
+                 max_roll_rad=1.0,
+                 max_pitch_rad=1.0,
+                 device=None,
+                 dtype=torch.float32):
+        """Initialize the controller object and control gains
+
+        Gains are scalars or (N,) sequences/tensors. device defaults to cuda when available.
+        """
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(device)
+        self.dtype = dtype
+
+        # gains are converted to tensors on assignment, see __setattr__
+        self.z_k_p = z_k_p
+        self.z_k_d = z_k_d
+        self.x_k_p = x_k_p
+        self.x_k_d = x_k_d
+        self.y_k_p = y_k_p
+        self.y_k_d = y_k_d
+        self.k_p_roll = k_p_roll
+        self.k_p_pitch = k_p_pitch
+        self.k_p_yaw = k_p_yaw
+        self.k_p_p = k_p_p
+        self.k_p_q = k_p_q
+        self.k_p_r = k_p_r
+        self.max_roll_rad = max_roll_rad
+        self.max_pitch_rad = max_pitch_rad
+
+        self._zero = self._tensor(0.0)
+
+        self._update_gains()
+
+    def __setattr__(self, name, value):
+        if name in Gains._fields:
+            value = self._tensor(value)
+        object.__setattr__(self, name, value)
+        # keep the stacked gains in step with the gain attributes, as controller.NonlinearController does
+        if name in Gains._fields and '_MOI_K_rate' in self.__dict__:
+            self._update_gains()
+
+    def _update_gains(self):
+        """Rebuild the stacked gains from the gain attributes"""
+        # gains stacked along the last axis: (2,)/(3,) when shared, (N,2)/(N,3) per drone
+        self._Kp_ne = torch.stack(torch.broadcast_tensors(self.x_k_p, self.y_k_p), dim=-1)
+        self._Kd_ne = torch.stack(torch.broadcast_tensors(self.x_k_d, self.y_k_d), dim=-1)
+        self._K_att = torch.stack(torch.broadcast_tensors(self.k_p_roll, self.k_p_pitch), dim=-1)
+        self._MOI_K_rate = self._tensor(MOI) * torch.stack(torch.broadcast_tensors(self.k_p_p, self.k_p_q, self.k_p_r),
+                                                           dim=-1)
+
+    def _tensor(self, value):
+        return torch.as_tensor(value, dtype=self.dtype, device=self.device)
+
+    def lateral_position_control(self, local_position_cmd, local_velocity_cmd, local_position, local_velocity,
+                                 acceleration_ff=None):
+        """Generate horizontal acceleration commands for N vehicles in the local frame
+
+        Args:
+            local_position_cmd: (N,2) desired positions in local frame [north, east]
+            local_velocity_cmd: (N,2) desired velocities in local frame [north_velocity, east_velocity]
+            local_position: (N,2) vehicle positions in the local frame [north, east]
+            local_velocity: (N,2) vehicle velocities in the local frame [north_velocity, east_velocity]
+            acceleration_ff: (N,2) feedforward acceleration command, zero if None
+
+        Returns: (N,2) desired vehicle accelerations in the local frame [north, east]
+        """
+        if acceleration_ff is None:
+            acceleration_ff = self._zero
+
+        err = local_position_cmd - local_position
+        err_dot = local_velocity_cmd - local_velocity
+
+        return -(self._Kp_ne * err + self._Kd_ne * err_dot + acceleration_ff)
+
+    def altitude_control(self, altitude_cmd, vertical_velocity_cmd, altitude, vertical_velocity, attitude,
+                         acceleration_ff=None, rot_mat=None):
+        """Generate vertical acceleration (thrust) commands for N vehicles
+
+        Args:
+            altitude_cmd: (N,) desired vertical positions (+up)
+            vertical_velocity_cmd: (N,) desired vertical velocities (+up)
+            altitude: (N,) vehicle vertical positions (+up)
+            vertical_velocity: (N,) vehicle vertical velocities (+up)
+            attitude: (N,3) vehicle attitudes (roll, pitch, yaw) in radians
+            acceleration_ff: (N,) feedforward acceleration command (+up), zero if None
+            rot_mat: optional (N,3,3) rotation matrices of attitude, as returned by euler2RM_torch
+
+        Returns: (N,) thrust commands (+up)
+        """
+        if acceleration_ff is None:
+            acceleration_ff = self._zero
+
+        if rot_mat is None:
+            b_z = torch.cos(attitude[:, 0]) * torch.cos(attitude[:, 1])
+        else:
+            b_z = rot_mat[:, 2, 2]
+
+        return _altitude_kernel(altitude_cmd, vertical_velocity_cmd, altitude, vertical_velocity, b_z,
+                                acceleration_ff, self.z_k_p, self.z_k_d, GRAVITY, MAX_THRUST)
+
+    def roll_pitch_controller(self, acceleration_cmd, attitude, thrust_cmd, rot_mat=None):
+        """ Generate the rollrate and pitchrate commands in the body frame for N vehicles
+
+        Args:
+            acceleration_cmd: (N,2) tensor (north_acceleration_cmd,east_acceleration_cmd) in m/s^2
+            attitude: (N,3) tensor (roll, pitch, yaw) in radians
+            thrust_cmd: (N,) vehicle thrust commands in Newton
+            rot_mat: optional (N,3,3) rotation matrices of attitude, as returned by euler2RM_torch
+
+        Returns: (N,2) tensor, desired rollrate (p) and pitchrate (q) commands in radians/s
+        """
+        if rot_mat is None:
+            rot_mat = euler2RM_torch(attitude[:, 0], attitude[:, 1], attitude[:, 2])
+
+        return _roll_pitch_kernel(acceleration_cmd, attitude, rot_mat, self._K_att, self.max_roll_rad,
+                                  self.max_pitch_rad)
+
+    def body_rate_control(self, body_rate_cmd, body_rate):
+        """ Generate the roll, pitch, yaw moment commands in the body frame for N vehicles
+
+        Args:
+            body_rate_cmd: (N,3) tensor (p_cmd,q_cmd,r_cmd) in radians/second^2
+            body_rate: (N,3) tensor (p,q,r) in radians/second^2
+
+        Returns: (N,3) tensor, desired roll moment, pitch moment, and yaw moment commands in Newtons*meters
+        """
+        return _body_rate_kernel(body_rate_cmd, body_rate, self._MOI_K_rate, MAX_TORQUE)
+
+    def yaw_control(self, yaw_cmd, yaw):
+        """ Generate the target yawrates for N vehicles
+
+        Args:
+            yaw_cmd: (N,) desired vehicle yaws in radians
+            yaw: (N,) vehicle yaws in radians
+
+        Returns: (N,) target yawrates in radians/sec
+        """
+        yaw_err = torch.remainder(yaw_cmd - yaw + math.pi, 2.0*math.pi) - math.pi
+
+        return self.k_p_yaw * yaw_err